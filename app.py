@@ -23,15 +23,29 @@ def load_corpus() -> pd.DataFrame:
     return corpus
 
 
-@st.cache_data
-def fetch_locations(docid) -> dict:
+@st.cache_resource
+def load_filter_index() -> dict:
+    """Build the filter lookups for the corpus once, and share them between reruns and sessions."""
+    logging.info("Building corpus filter index")
+    return utils.build_filter_index(load_corpus())
+
+
+@st.cache_data(ttl=utils.GEO_CACHE_TTL, show_spinner="Henter stedsnavn…")
+def fetch_locations(docid) -> pd.DataFrame:
     """Fetch locations from the corpus."""
     logging.info("Fetching locations")
-    locations = utils.geo_locations(docid)
+    locations = utils.cached_geo_locations(docid)
     # locations = utils.many_geo_locations(docids)
     return locations
 
 
+@st.cache_data(ttl=utils.GEO_CACHE_TTL, max_entries=100)
+def locations_excel(docid) -> bytes:
+    """Serialize the locations for a publication to an excel file."""
+    logging.info("Writing locations to excel")
+    return utils.to_excel(fetch_locations(docid))
+
+
 # %%
 def main():
     """Main function for the app."""
@@ -55,12 +69,14 @@ def main():
 
     settings.write("### Filtrer tekstutvalg")
     settings.write(f"Totalt antall publikasjoner i korpuset: **{corpus.shape[0]}**")
-    subcorpus = utils.corpus_parameters(corpus, settings)
+    subcorpus = utils.corpus_parameters(corpus, settings, load_filter_index())
     docid = subcorpus.dhlabid.values[0]
+    urn = subcorpus.urn.values[0]
+    locations = fetch_locations(docid)
 
     # %%
     settings.write("### Kartvisning")
-    mapfilter1, mapfilter2, _ = settings.columns([2, 4, 2])
+    mapfilter1, mapfilter2, mapfilter3 = settings.columns([2, 4, 2])
     freq_lim = mapfilter1.number_input(
         "Sett nedre frekvensgrense",
         min_value=1,
@@ -73,6 +89,11 @@ def main():
         f"stedsnavn_dhlabid-{docid}.xlsx",
         help="Navn på nedlastbar Excel-fil med stedsnavnene.",
     )
+    fast_map = mapfilter3.toggle(
+        "Rask kartvisning",
+        value=False,
+        help="Tegn stedsnavnene som punkter med WebGL. Raskere for mange stedsnavn, men uten lenker i oppslagene.",
+    )
     # selected_features = mapfilter2.multiselect(
     #    "Velg kode for stedstyper",
     #    utils.feature_codes,
@@ -89,14 +110,8 @@ def main():
 
     ### PLOT MAP
 
-    # Initialise a Folium map at a global scale
-    m = folium.Map(location=[35, 0], zoom_start=2)
-
     # %%
     if update_map:
-        # %%
-        locations = fetch_locations(docid)
-        # %%
         if locations.empty:
             col3.write("Ingen stedsnavn å vise fra den valgte tittelen. Prøv en annen tittel.")
         else:
@@ -104,25 +119,21 @@ def main():
             col3.write(f"Viser {locations.shape[0]} stedsnavn. ")
             filebutton = col2.download_button(
                 ":arrow_down:",
-                utils.to_excel(locations),
+                locations_excel(docid),
                 filnavn,
                 help="Last ned stedsnavnene i excelformat. Åpnes i Excel eller tilsvarende.",
             )
 
             if filebutton:
                 pass
-            for i, row in locations.iterrows():
-                if row["frekv"] < freq_lim:
-                    continue
-                try:
-                    urn = subcorpus.loc[subcorpus.dhlabid == row["dhlabid"], "urn"].values
-                    pin = utils.create_map_pin(row, urn)
-                    pin.add_to(m)
-                except IndexError:
-                    st.warning("Kunne ikke plotte stedsnavn")
-                    logging.warning(f"IndexError: {row}")
-                    continue
-            streamlit_folium.folium_static(m, height=700, width=1000)
+            locations = locations[locations.frekv >= freq_lim]
+            if fast_map:
+                st.pydeck_chart(utils.create_scatter_map(locations))
+            else:
+                # Initialise a Folium map at a global scale
+                m = folium.Map(location=[35, 0], zoom_start=2)
+                utils.create_map_pins(locations, urn).add_to(m)
+                streamlit_folium.folium_static(m, height=700, width=1000)
         # Save the map to an HTML file
         # map_file = "map.html"
         # m.save(map_file)
@@ -1,31 +1,82 @@
 # %%
 import re
+import html
 import json
 import logging
+import os
+import tempfile
+import time
 from typing import Iterable
 
 import dhlab as dh
-import folium
+from dhlab.api.dhlab_api import get_metadata
+from folium.plugins import FastMarkerCluster
+import orjson
 import pandas as pd
 import pyarrow as pa
+import pydeck as pdk
 import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
 from langcodes import Language
 from io import BytesIO
+from pathlib import Path
 from string import punctuation
+from urllib.parse import quote
 
 from feature_values import feature_classes, feature_codes, feature_colour_map
 
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4))
+
+PUNCTUATION_RE = re.compile("[" + re.escape(punctuation) + "]")
+
+CACHE_DIR = Path.home() / ".cache" / "litteraturkart"
+CORPUS_CACHE_TTL = 24 * 60 * 60  # seconds
+GEO_CACHE_TTL = 60 * 60  # seconds, in memory
+GEO_DISK_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+
+METADATA_COLUMNS = [
+    "urn",
+    "dhlabid",
+    "title",
+    "authors",
+    "city",
+    "year",
+    "publisher",
+    "langs",
+    "subjects",
+    "ddc",
+    "genres",
+    "literaryform",
+    "doctype",
+    "ocr_creator",
+]
+
 
 def format_filename(full_title: str) -> str:
     """Replace punctuation and whitespace in a string with hyphens."""
     # Split main title and subtitle
     title = full_title.split(":")[0].strip()
-    return "-".join(re.sub("[" + punctuation + "]", "", title).split())
+    return "-".join(PUNCTUATION_RE.sub("", title).split())
+
+
+def format_filenames(full_titles: pd.Series) -> pd.Series:
+    r"""Vectorized `format_filename` over a Series of titles.
+
+    Works on object values, since whitespace splitting on Arrow strings only knows ASCII whitespace.
+
+    >>> titles = pd.Series(["Et\xa0Hjem\u2003i Norden: roman"], dtype=pd.ArrowDtype(pa.string()))
+    >>> format_filenames(titles).tolist() == [format_filename(title) for title in titles]
+    True
+    """
+    titles = full_titles.astype(object).str.partition(":")[0]
+    return titles.str.replace(PUNCTUATION_RE, "", regex=True).str.split().str.join("-")
 
 
 def imag_corpus():
     logging.info("fetching corpus metadata from dhlab API")
-    res = requests.get(f"{dh.constants.BASE_URL}/imagination/all")
+    res = session.get(f"{dh.constants.BASE_URL}/imagination/all")
     if res.status_code == 200:
         pa_tab = pa.Table.from_pylist(res.json())
         df = pa_tab.to_pandas(types_mapper=pd.ArrowDtype)
@@ -34,54 +85,133 @@ def imag_corpus():
     return df
 
 
+def read_parquet_cache(path: Path, ttl: int = None):
+    """Read a dataframe from a parquet cache file, or return None on a cache miss.
+
+    Files older than `ttl` seconds count as a miss, and unreadable files are removed.
+    """
+    try:
+        if ttl is not None and time.time() - path.stat().st_mtime >= ttl:
+            return None
+        return pd.read_parquet(path, dtype_backend="pyarrow")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, pa.ArrowException) as e:
+        logging.warning(f"removing unreadable cache file {path}: {e}")
+        path.unlink(missing_ok=True)
+        return None
+
+
+def write_parquet_cache(df: pd.DataFrame, path: Path):
+    """Write a dataframe to a parquet cache file through a temporary file, so readers never see a partial file."""
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+    except (OSError, ValueError, pa.ArrowException) as e:
+        logging.warning(f"could not write cache file {path}: {e}")
+        if tmp_path is not None:
+            Path(tmp_path).unlink(missing_ok=True)
+
+
+def cached_imag_corpus(ttl: int = CORPUS_CACHE_TTL) -> pd.DataFrame:
+    """Read the corpus metadata from a parquet file on disk, refetching it when older than `ttl` seconds.
+
+    If the API request fails, a stale cached file is used rather than an empty frame.
+    """
+    path = CACHE_DIR / "imag_corpus.parquet"
+    df = read_parquet_cache(path, ttl)
+    if df is not None:
+        logging.info(f"read corpus metadata from {path}")
+        return df
+    df = imag_corpus()
+    if df.empty:
+        stale = read_parquet_cache(path)
+        if stale is not None:
+            logging.warning(f"using stale corpus metadata from {path}")
+            return stale
+        return df
+    write_parquet_cache(df, path)
+    return df
+
+
 def get_imag_corpus():
     """Fetch the full collection of ImagiNation corpus metadata and wrap it in a dataframe."""
-    logging.info("creating corpus object from metadata")
-    im = imag_corpus()
-    c = dh.Corpus()
-    c.extend_from_identifiers(im.urn)
-    corpus = c.frame
-    corpus.dhlabid = corpus.dhlabid.astype(int)
-    corpus = corpus[
-        [
-            "urn",
-            "dhlabid",
-            "title",
-            "authors",
-            "city",
-            "year",
-            "publisher",
-            "langs",
-            "subjects",
-            "ddc",
-            "genres",
-            "literaryform",
-            "doctype",
-            "ocr_creator",
-        ]
-    ]
-    corpus = corpus.merge(im[["urn", "category"]], left_on="urn", right_on="urn")
-    corpus["metatitle"] = corpus.apply(combine_title_info, axis=1)
+    logging.info("creating corpus from metadata")
+    im = cached_imag_corpus()
+    present = [col for col in METADATA_COLUMNS if col in im.columns]
+    missing = [col for col in METADATA_COLUMNS if col not in im.columns]
+    corpus = im[present + ["category"]]
+    if missing:
+        # A single bulk request for the fields the ImagiNation endpoint lacks
+        logging.info(f"fetching {missing} for {im.shape[0]} publications")
+        metadata = get_metadata(im.urn.to_list())
+        corpus = corpus.merge(metadata[["urn"] + missing], on="urn")
+    corpus = corpus.drop_duplicates("urn")[METADATA_COLUMNS + ["category"]]
+    corpus = corpus.reset_index(drop=True)
+    corpus["dhlabid"] = pd.to_numeric(corpus["dhlabid"], downcast="integer")
+    corpus["year"] = pd.to_numeric(corpus["year"], downcast="unsigned")
+    for col in ("category", "literaryform", "doctype", "ocr_creator"):
+        corpus[col] = corpus[col].astype("category")
+    corpus["metatitle"] = format_titles(corpus["title"], corpus["authors"], corpus["year"])
     return corpus
 
 # %%
+def geo_frame_from_json(content: bytes) -> pd.DataFrame:
+    """Decode a JSON response body with orjson into a pyarrow-backed dataframe.
+
+    Lists of records go straight into an Arrow table, other layouts through `pd.DataFrame.from_dict`.
+    """
+    data = orjson.loads(content)
+    if isinstance(data, list):
+        df = pa.Table.from_pylist(data).to_pandas(types_mapper=pd.ArrowDtype)
+    else:
+        df = pd.DataFrame.from_dict(data).convert_dtypes(dtype_backend='pyarrow')
+    return downcast_locations(df)
+
+
+def downcast_locations(data: pd.DataFrame) -> pd.DataFrame:
+    """Store frequencies in the smallest unsigned type that holds them.
+
+    Coordinates are kept as float64, since float32 adds visible rounding noise to exported values.
+    """
+    if "frekv" in data.columns:
+        data["frekv"] = pd.to_numeric(data["frekv"], downcast="unsigned")
+    return data
+
+
 def geo_locations(dhlabid):
     """Fetch geolocation info for placenames in a given publication."""
-    res = requests.get(
+    res = session.get(
         f"{dh.constants.BASE_URL}/imagination_geo_data", params={"dhlabid": dhlabid}
     )
     # if res.status_code == 200:
 
     try:
         res.raise_for_status()
-        data = pd.DataFrame.from_dict(res.json()).convert_dtypes(dtype_backend='pyarrow')
-    except requests.exceptions.RequestException as e:
+        data = geo_frame_from_json(res.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         print(e)
         data = pd.DataFrame()
     # else:
 
     return data
 
+
+def cached_geo_locations(dhlabid, ttl: int = GEO_DISK_CACHE_TTL) -> pd.DataFrame:
+    """Read the geolocations for a publication from a parquet file on disk, refetching them when older than `ttl` seconds."""
+    path = CACHE_DIR / "geo_locations" / f"{int(dhlabid)}.parquet"
+    data = read_parquet_cache(path, ttl)
+    if data is not None:
+        return data
+    data = geo_locations(dhlabid)
+    if not data.empty:
+        write_parquet_cache(data, path)
+    return data
+
 # %%
 def load_corpus_csv(filename: str):
     c = dh.Corpus.from_csv(filename)
@@ -102,7 +232,7 @@ def to_excel(df):
     Copied function from https://github.com/NationalLibraryOfNorway/dhlab-app-corpus/blob/main/app/app.py
     """
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
         df.to_excel(writer, index=False, sheet_name="Stedsnavn")
     processed_data = output.getvalue()
     return processed_data
@@ -143,6 +273,25 @@ def format_title(title: str, authors: str = None, year: int = None) -> str:
     return credited_title
 
 
+def format_authors(authors: pd.Series) -> pd.Series:
+    """Vectorized `format_author` over a Series of author strings."""
+    names = authors.str.split("/").explode().str.partition(",")
+    last_names = names[0].str.strip()
+    first_names = names[2].str.partition(",")[0].str.strip()
+    has_first_name = (names[1] == ",").fillna(False).astype(bool)
+    fullnames = (first_names + " " + last_names).where(has_first_name, last_names)
+    return fullnames.dropna().groupby(level=0).agg(", ".join).reindex(authors.index)
+
+
+def format_titles(titles: pd.Series, authors: pd.Series, years: pd.Series) -> pd.Series:
+    """Vectorized `format_title`, formatting each row as 'AUTHOR : TITLE (YEAR)'."""
+    author_names = format_authors(authors)
+    author_prefix = (author_names + " : ").where(author_names.fillna("") != "", "")
+    years = years.astype("Int64")
+    year_suffix = (" (" + years.astype(str) + ")").where(years.fillna(0) != 0, "")
+    return author_prefix + '"' + titles.astype(str) + '"' + year_suffix
+
+
 def format_language(option: str) -> str:
     """Format language codes with their full name (in English)."""
     return Language.get(option).display_name()
@@ -153,29 +302,39 @@ def to_csv(data: pd.DataFrame):
 
 
 # DATA WRANGLING
+@st.cache_data
 def extract_unique_values(data: pd.Series, sep: str = "/") -> list:
     """Format a list of unique values from a multivalue string from a pandas Series."""
-    return sorted(
-        list(
-            {
-                unit.strip()
-                for item in data.unique()
-                if isinstance(item, str)
-                for unit in item.split(sep)
-                if unit
-            }
-        )
-    )
+    units = data.dropna().str.split(sep).explode().str.strip()
+    return sorted(units[units != ""].unique())
+
+
+def explode_multivalue(data: pd.Series, sep: str = "/") -> pd.Series:
+    """Split a multivalue string Series into one row per value, keeping the original index."""
+    return data.str.split(sep).explode().str.strip()
+
+
+def build_filter_index(corpus: pd.DataFrame) -> dict:
+    """Precompute lookup structures for the multivalue corpus filters.
+
+    Meant to be built once per corpus load and passed on to `filtered_selection`.
+    """
+    return {
+        "authors": explode_multivalue(corpus["authors"]),
+        "langs": multivalue_dummies(corpus["langs"]),
+    }
+
+
+def multivalue_dummies(data: pd.Series, sep: str = "/") -> pd.DataFrame:
+    """Make a boolean indicator matrix with one column per unique value in a multivalue string Series."""
+    dummies = pd.get_dummies(explode_multivalue(data, sep), dtype=bool)
+    return dummies.groupby(level=0).any().reindex(data.index, fill_value=False)
 
 
 def bool_filter(data: pd.Series, examples: Iterable, regex=True) -> pd.Series:
     """Filter a pandas Series with a list of examples."""
     if regex:
-        regpat = regpat = (
-            ("|".join(examples) if examples else "")
-            .replace("(", "\(")
-            .replace(")", "\)")
-        )
+        regpat = "|".join(re.escape(example) for example in examples) if examples else ""
         boolean_series = data.str.contains(regpat, regex=True)
     else:
         try:
@@ -186,6 +345,36 @@ def bool_filter(data: pd.Series, examples: Iterable, regex=True) -> pd.Series:
     return boolean_series
 
 
+def multivalue_filter(
+    data: pd.Series, examples: Iterable, exploded: pd.Series = None, sep: str = "/"
+) -> pd.Series:
+    """Filter a pandas Series of multivalue strings on exact membership of the examples.
+
+    `exploded` is the Series split into one row per value, as from `explode_multivalue`.
+    """
+    if not examples:
+        return pd.Series(True, index=data.index)
+    if exploded is None:
+        exploded = explode_multivalue(data, sep)
+    matches = exploded[exploded.isin(list(examples))].index
+    return pd.Series(data.index.isin(matches), index=data.index)
+
+
+def dummies_filter(
+    data: pd.Series, examples: Iterable, dummies: pd.DataFrame = None, sep: str = "/"
+) -> pd.Series:
+    """Filter a pandas Series of multivalue strings on exact membership of the examples.
+
+    Looks the examples up in an indicator matrix, as from `multivalue_dummies`,
+    which suits columns with few distinct values.
+    """
+    if not examples:
+        return pd.Series(True, index=data.index)
+    if dummies is None:
+        dummies = multivalue_dummies(data, sep)
+    return dummies.reindex(columns=list(examples), fill_value=False).any(axis=1)
+
+
 def filtered_selection(
     meta_df: pd.DataFrame,
     # selection_col: Union[list, str] = "dhlabid",
@@ -198,20 +387,25 @@ def filtered_selection(
     languages: Iterable = None,
     publishers: Iterable = None,
     places: Iterable = None,
+    filter_index: dict = None,
 ) -> pd.Series:
     """Reduce the available selection_col column values from the corpus,
     given the other chosen metadata parameters.
     dhlabid,urn,authors,year,langs,title
+
+    filter_index: precomputed lookups from `build_filter_index`, built from meta_df if not given
     """
+    if filter_index is None:
+        filter_index = build_filter_index(meta_df)
     doc_sel = bool_filter(meta_df["dhlabid"], docids, regex=False)
-    cat_sel = bool_filter(meta_df["category"], categories)
-    auth_sel = bool_filter(meta_df["authors"], authors)
+    cat_sel = bool_filter(meta_df["category"], categories, regex=False)
+    auth_sel = multivalue_filter(meta_df["authors"], authors, filter_index["authors"])
     title_sel = bool_filter(
         meta_df["title"], titles, regex=False
     )
     # publisher_sel = bool_filter(meta_df["publisher"], publishers)
     # place_sel = bool_filter(meta_df["place"], places)
-    lang_sel = bool_filter(meta_df["langs"], languages)
+    lang_sel = dummies_filter(meta_df["langs"], languages, filter_index["langs"])
     period = (from_year - 1 < meta_df["year"]) & (meta_df["year"] < to_year + 1)
 
     # selection = meta_df[selection_col][
@@ -231,25 +425,35 @@ def filter_unique_options(df, col, **kwargs):
     subcorpus = filtered_selection(df, kwargs)
     return extract_unique_values(subcorpus[col])
 
-def combine_title_info(row) -> list:
-    """Combine title, author and year into a single string."""
-    # row = corpus.loc[corpus.dhlabid == dhlabid]
-    return format_title(row["title"], row["authors"], row["year"])
 
+@st.cache_data(hash_funcs={pd.DataFrame: lambda df: df.shape})
+def filter_options(metadata: pd.DataFrame) -> dict:
+    """Collect the option lists for the corpus filter widgets.
+
+    The corpus is loaded once and never changes within the app, so the frame is hashed on its shape only.
+    """
+    return {
+        "categories": list(metadata.category.unique()),
+        "authors": extract_unique_values(metadata["authors"]),
+        "langs": extract_unique_values(metadata["langs"]),
+    }
 
-def corpus_parameters(metadata, param_box):
+
+def corpus_parameters(metadata, param_box, filter_index=None):
     """Streamlit widget to filter the corpus with metadata parameters.
 
     Args:
         metadata: pd.DataFrame
         param_box: A streamlit container, expander or similar, to insert the input widgets into
+        filter_index: Precomputed filter lookups for metadata, see `build_filter_index`
     """
 
     filter1, filter2 = param_box.columns([6, 4], gap="large")
+    options = filter_options(metadata)
 
     chosen_categories = filter1.multiselect(
         label="Tekstkategori",
-        options=metadata.category.unique(),
+        options=options["categories"],
         placeholder="Velg en kategori",
     )
 
@@ -259,7 +463,7 @@ def corpus_parameters(metadata, param_box):
 
     chosen_authors = filter1.multiselect(
         "Forfatter",
-        extract_unique_values(metadata["authors"]),
+        options["authors"],
         [],
         placeholder="Velg en forfatter",
         format_func=format_author,
@@ -268,7 +472,7 @@ def corpus_parameters(metadata, param_box):
 
     chosen_language = filter2.multiselect(
         "Språk",
-        extract_unique_values(metadata["langs"]),
+        options["langs"],
         [],
         format_func=format_language,
         placeholder="Velg språk",
@@ -283,6 +487,7 @@ def corpus_parameters(metadata, param_box):
         languages=chosen_language,
         from_year=from_year,
         to_year=to_year,
+        filter_index=filter_index,
     )
 
     chosen_title = filter1.selectbox(
@@ -298,27 +503,71 @@ def corpus_parameters(metadata, param_box):
     return subcorpus
 
 
-def create_map_pin(row: pd.Series, urn: str):
-    """Create an html string for a folium map pin popup."""
-    # feature_code = row.feature_code
-    feature_class = row.feature_class
-    html = f"""
-    <h4>{row['token']} <em>{row['name']}</em></h4>
-    <p> Frekvens: {row['frekv']}</p>
-    <p><a href=https://www.nb.no/search?q={row.token}&mediatype=b%C3%B8ker&fromDate=18140101&toDate=19051231 target='_blank'> {row.token} fra 1814 til 1905</a></p>
-    <p><a href=https://www.nb.no/items/{urn}?searchText={row.token} target='_blank'>{row.token} i teksten</a></p>"""
-
-    iframe = folium.IFrame(html=html, width=200, height=200)
-    popup_frame = folium.Popup(iframe, max_width=2600)
-    # pin_size = 20 + row.frekv
-    return folium.Marker(
-        location=(row.latitude, row.longitude),
-        icon=folium.Icon(
-            color=feature_colour_map.get(feature_class, "blue"),
-            icon="drop",
-            prefix="fa",
-        ),
-        popup=popup_frame,
+MAP_PIN_CALLBACK = """function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: "drop", prefix: "fa", markerColor: row[3]});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[2], {maxWidth: 2600});
+    return marker;
+}"""
+
+
+def map_pin_html(locations: pd.DataFrame, urn: str) -> pd.Series:
+    """Create the html strings for the folium map pin popups, one per placename.
+
+    OCR text is html-escaped, and url-quoted in links, since the popups are inserted into the page as is.
+    """
+    raw_token = locations.token.astype(str)
+    token = raw_token.map(html.escape)
+    query = raw_token.map(quote)
+    name = locations["name"].astype(str).map(html.escape)
+    frekv = locations.frekv.astype(str)
+    return (
+        "\n    <h4>" + token + " <em>" + name + "</em></h4>"
+        + "\n    <p> Frekvens: " + frekv + "</p>"
+        + "\n    <p><a href=https://www.nb.no/search?q=" + query
+        + "&mediatype=b%C3%B8ker&fromDate=18140101&toDate=19051231 target='_blank'> "
+        + token + " fra 1814 til 1905</a></p>"
+        + f"\n    <p><a href=https://www.nb.no/items/{urn}?searchText=" + query
+        + " target='_blank'>" + token + " i teksten</a></p>"
+    )
+
+
+def create_map_pins(locations: pd.DataFrame, urn: str) -> FastMarkerCluster:
+    """Create a cluster of folium map pins, one per placename, rendered in the browser.
+
+    Each pin is passed to Leaflet as a row of [latitude, longitude, popup html, colour],
+    and turned into a marker by `MAP_PIN_CALLBACK`.
+    """
+    popups = map_pin_html(locations, urn)
+    colours = locations.feature_class.map(feature_colour_map).fillna("blue")
+    data = list(
+        zip(
+            locations.latitude.to_numpy().tolist(),
+            locations.longitude.to_numpy().tolist(),
+            popups.to_numpy().tolist(),
+            colours.to_numpy().tolist(),
+        )
+    )
+    return FastMarkerCluster(data, callback=MAP_PIN_CALLBACK)
+
+
+def create_scatter_map(locations: pd.DataFrame) -> pdk.Deck:
+    """Create a pydeck map with one WebGL point per placename, sized by frequency."""
+    layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=locations[["latitude", "longitude", "token", "name", "frekv"]],
+        get_position="[longitude, latitude]",
+        get_radius="frekv * 1000",
+        radius_min_pixels=3,
+        get_fill_color=[0, 92, 230, 160],
+        pickable=True,
+    )
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=pdk.ViewState(latitude=35, longitude=0, zoom=2),
+        # A text tooltip, so OCR text is never inserted into the page as html
+        tooltip={"text": "{token} ({name})\nFrekvens: {frekv}"},
+        map_style="light",
     )
 
 # %%